@@ -1,25 +1,93 @@
+import asyncio
+import logging
+import multiprocessing
 import os
 import re
-from io import BytesIO
+import tempfile
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from hashlib import blake2b
 from pathlib import Path
-from urllib.request import urlopen
-from typing import List
+from urllib.request import Request, urlopen
+from typing import Any, AsyncIterator, Callable, Iterator, List, Literal, Optional, Tuple
 
+import orjson
+import psutil
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from pypdf import PdfReader
+from starlette.background import BackgroundTask
+
+# Keep llama.cpp's OpenMP workers on distinct cores. OpenMP reads these when
+# the library is loaded, so they must be set before llama_cpp is imported.
+os.environ.setdefault("OMP_PROC_BIND", "close")
+os.environ.setdefault("OMP_PLACES", "cores")
 
 try:
-    from llama_cpp import Llama
+    from llama_cpp import GGML_TYPE_Q8_0, Llama, llama_supports_gpu_offload
+    from llama_cpp.llama import LlamaState
+    from llama_cpp.llama_cache import LlamaRAMCache
 except Exception:  # pragma: no cover
     Llama = None
+    LlamaState = None
+    LlamaRAMCache = object
+
 
+logger = logging.getLogger(__name__)
 
 APP_TITLE = "Report AI Agent"
 MODEL_PATH_ENV = "LLAMA_MODEL_PATH"
 MODEL_URL_ENV = "LLAMA_MODEL_URL"
+SERVER_URL_ENV = "LLAMA_SERVER_URL"
+SERVER_PARALLEL_ENV = "LLAMA_SERVER_PARALLEL"
+N_GPU_LAYERS_ENV = "LLAMA_N_GPU_LAYERS"
+FLASH_ATTN_ENV = "LLAMA_FLASH_ATTN"
+KV_Q8_ENV = "LLAMA_KV_Q8"
+PROMPT_CACHE_MB_ENV = "LLAMA_PROMPT_CACHE_MB"
+N_THREADS_ENV = "LLAMA_N_THREADS"
+N_THREADS_BATCH_ENV = "LLAMA_N_THREADS_BATCH"
+EMBED_MODEL_PATH_ENV = "LLAMA_EMBED_MODEL_PATH"
+EMBED_MODEL_URL_ENV = "LLAMA_EMBED_MODEL_URL"
 DEFAULT_MODEL_PATH = "/models/model.gguf"
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+PDF_EXTRACT_WORKERS = min(8, os.cpu_count() or 1)
+PDF_PAGES_PER_WORKER = 16
+# Leaves room for a preamble and the generated text within n_ctx=4096.
+CHUNK_MAX_TOKENS = 1800
+# Passage size for QA retrieval; must stay within the embedding model's context.
+RETRIEVAL_PASSAGE_TOKENS = 300
+
+SUMMARY_PREAMBLE = (
+    "You are an analyst assistant. Write in English. Produce EXACTLY 5–10 sentences. "
+    "No meta commentary (e.g., 'the report says...'). "
+    "No lists or numbering, only coherent and logically ordered prose. "
+    "Use only facts from the report, no speculation. Do not repeat yourself.\n\n"
+)
+QA_PREAMBLE = (
+    "You are an analyst assistant. Write in English. Answer only using the report content. "
+    "No meta commentary or speculation. Do not repeat yourself. "
+    "If the answer is not in the text, say: \"The report does not specify this.\".\n\n"
+)
+
+PromptKind = Literal["summary", "qa"]
+
+# A sentence runs up to ".", "!" or "?"; a dot inside a number (3.5) or
+# followed by another dot (...) does not end it.
+_SENTENCE_RE = re.compile(r"(?:[^.!?]+|\.(?=\.)|(?<=\d)\.(?=\d))*(?:[!?]|\.|\Z)")
+# List numbering such as "1." or "12)" at a line start (but not "3.5").
+_NUMBERING_RE = re.compile(r"^\s*\d{1,3}[.)](?:\s+|$)")
+
+REPORT_CACHE_MAX_ENTRIES = 10
+REPORT_CACHE_MAX_BYTES = 1 << 30
+TEXT_CACHE_MAX_ENTRIES = 32
+TEXT_CACHE_MAX_CHARS = 100_000_000
+PASSAGE_CACHE_MAX_ENTRIES = 16
+# Bounds the cached embeddings; one vector per passage.
+PASSAGE_CACHE_MAX_PASSAGES = 20_000
 
 
 class SummaryResponse(BaseModel):
@@ -35,17 +103,145 @@ class DebugTextResponse(BaseModel):
     length: int
 
 
-app = FastAPI(title=APP_TITLE)
+class LRUCache:
+    """Thread-safe LRU mapping bounded by entry count and total value size."""
+
+    def __init__(self, max_entries: int, max_size: int, sizeof: Callable[[Any], int]) -> None:
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self._sizeof = sizeof
+        self._items: "OrderedDict[str, Any]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for a key and mark it recently used."""
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Any) -> None:
+        """Store a value, evicting least recently used ones over the limits."""
+        size = self._sizeof(value)
+        if size > self.max_size:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= self._sizeof(old)
+            self._items[key] = value
+            self._size += size
+            while len(self._items) > self.max_entries or self._size > self.max_size:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= self._sizeof(evicted)
+
+
+class ReportKVCache(LRUCache):
+    """LRU of llama states prefilled with a preamble and a report excerpt."""
+
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        super().__init__(max_entries, max_bytes, _state_nbytes)
+
+    @staticmethod
+    def key(prefix: str) -> str:
+        """Return the cache key for a prompt prefix."""
+        return blake2b(prefix.encode("utf-8")).hexdigest()
+
+
+def _state_nbytes(state: "LlamaState") -> int:
+    """Return the memory held by a llama state snapshot.
+
+    Besides the KV data, each snapshot copies the logits buffer
+    (n_batch x n_vocab float32, ~300 MB for a 150k vocabulary).
+    """
+    return state.llama_state_size + state.scores.nbytes
+
+
+class PromptRAMCache(LlamaRAMCache):
+    """LlamaRAMCache whose capacity also counts each entry's saved logits."""
+
+    @property
+    def cache_size(self) -> int:
+        return sum(_state_nbytes(state) for state in self.cache_state.values())
+
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Load and warm up the model before serving, so no request pays for it."""
+    try:
+        # One decoded token pages in the weights and builds the decode graph.
+        _generate(_load_llm(), "", kind="summary", max_tokens=1)
+        _load_embedder()
+    except Exception as exc:
+        # llama.cpp raises ValueError when the model or context cannot be
+        # created (e.g. not enough GPU memory); the next request retries.
+        logger.warning("Model not loaded at startup: %s", getattr(exc, "detail", exc))
+    yield
+    _shutdown_pdf_pool()
+
+
+app = FastAPI(title=APP_TITLE, lifespan=_lifespan, default_response_class=ORJSONResponse)
 
 
 _llm = None
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+# llama.cpp contexts are not reentrant; every eval/sample goes through this lock.
+_llm_lock = threading.RLock()
+# KV state right after prefilling each static preamble, restored per request.
+_preamble_state_summary: Optional["LlamaState"] = None
+_preamble_state_qa: Optional["LlamaState"] = None
+# KV state after QA_PREAMBLE + REPORT, so follow-up questions skip the report.
+_report_cache = ReportKVCache(REPORT_CACHE_MAX_ENTRIES, REPORT_CACHE_MAX_BYTES)
+# Extracted PDF text keyed by a hash of the uploaded bytes.
+_text_cache = LRUCache(TEXT_CACHE_MAX_ENTRIES, TEXT_CACHE_MAX_CHARS, len)
+_embedder = None
+_embed_lock = threading.Lock()
+# (passages, embeddings, token counts) of a report, keyed by a hash of its text.
+_passage_cache = LRUCache(
+    PASSAGE_CACHE_MAX_ENTRIES, PASSAGE_CACHE_MAX_PASSAGES, lambda cached: len(cached[0])
+)
+
+
+def _env_int(name: str, default: int) -> int:
+    """Read an integer setting from the environment."""
+    value = os.getenv(name, "").strip()
+    return int(value) if value else default
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    """Read a boolean setting (1/true/yes/on) from the environment."""
+    value = os.getenv(name, "").strip().lower()
+    if not value:
+        return default
+    return value in ("1", "true", "yes", "on")
+
+
+def _cpu_counts() -> Tuple[int, int]:
+    """Return the (physical, logical) CPU counts available to this process."""
+    if hasattr(os, "sched_getaffinity"):
+        logical = len(os.sched_getaffinity(0))
+    else:
+        logical = os.cpu_count() or 4
+    physical = psutil.cpu_count(logical=False) or max(1, logical // 2)
+    return min(physical, logical), logical
 
 
 def _load_llm() -> "Llama":
-    """Load and cache the Llama model, downloading it if needed."""
+    """Return the shared Llama model, loading it on first use."""
     global _llm
     if _llm is not None:
         return _llm
+    with _llm_lock:
+        if _llm is None:
+            _llm = _create_llm()
+        return _llm
+
+
+def _create_llm() -> "Llama":
+    """Load the Llama model, downloading it if needed."""
     if Llama is None:
         raise HTTPException(
             status_code=500,
@@ -68,19 +264,132 @@ def _load_llm() -> "Llama":
                 ),
             )
         _download_model(model_url, model_path)
-    _llm = Llama(
+    n_gpu_layers = _env_int(N_GPU_LAYERS_ENV, -1)
+    flash_attn = _env_flag(FLASH_ATTN_ENV, True)
+    # A q8_0 KV cache halves attention memory traffic; on by default on CPU,
+    # where it is bandwidth-bound. llama.cpp can only quantize V with flash attention.
+    cpu_only = n_gpu_layers == 0 or not llama_supports_gpu_offload()
+    kv_q8 = _env_flag(KV_Q8_ENV, cpu_only)
+    type_k = GGML_TYPE_Q8_0 if kv_q8 else None
+    type_v = GGML_TYPE_Q8_0 if kv_q8 and flash_attn else None
+    # Decode is memory-bound and slows down when SMT siblings compete, while
+    # the prefill matmuls still gain from every logical core.
+    physical, logical = _cpu_counts()
+    llm = Llama(
         model_path=model_path,
         n_ctx=4096,
-        n_threads=os.cpu_count() or 4,
+        n_batch=512,
+        n_ubatch=512,
+        n_threads=_env_int(N_THREADS_ENV, physical),
+        n_threads_batch=_env_int(N_THREADS_BATCH_ENV, logical),
+        n_gpu_layers=n_gpu_layers,
+        offload_kqv=True,
+        flash_attn=flash_attn,
+        type_k=type_k,
+        type_v=type_v,
         verbose=False,
     )
-    return _llm
+    # llama-cpp-python snapshots each completion and, for a new prompt, restores
+    # the snapshot sharing the longest token prefix (e.g. rewrite/retry prompts
+    # over the same report), on top of the explicit preamble/report states.
+    prompt_cache_mb = _env_int(PROMPT_CACHE_MB_ENV, 2048)
+    if prompt_cache_mb > 0:
+        llm.set_cache(PromptRAMCache(capacity_bytes=prompt_cache_mb << 20))
+    _prime_preambles(llm)
+    return llm
+
+
+def _load_embedder() -> Optional["Llama"]:
+    """Return the embedding model for QA retrieval, or None if not configured."""
+    global _embedder
+    model_path = os.getenv(EMBED_MODEL_PATH_ENV)
+    if not model_path:
+        return None
+    with _embed_lock:
+        if _embedder is not None:
+            return _embedder
+        if Llama is None:
+            raise HTTPException(
+                status_code=500,
+                detail="llama-cpp-python is not available. Install dependencies.",
+            )
+        if not os.path.exists(model_path):
+            model_url = os.getenv(EMBED_MODEL_URL_ENV)
+            if not model_url:
+                raise HTTPException(
+                    status_code=500,
+                    detail=(
+                        f"Embedding model file not found: {model_path}. "
+                        f"Set {EMBED_MODEL_URL_ENV} to auto-download a GGUF model."
+                    ),
+                )
+            _download_model(model_url, model_path)
+        _embedder = Llama(
+            model_path=model_path,
+            embedding=True,
+            n_ctx=512,
+            n_batch=512,
+            n_ubatch=512,
+            verbose=False,
+        )
+        return _embedder
+
+
+def _prefill(llm: "Llama", text: str) -> "LlamaState":
+    """Evaluate a prompt prefix on top of the current KV state and snapshot it."""
+    tokens = llm.tokenize(text.encode("utf-8"), special=True)
+    n_past = Llama.longest_token_prefix(llm.input_ids[: llm.n_tokens].tolist(), tokens)
+    llm.n_tokens = n_past
+    llm.eval(tokens[n_past:])
+    return llm.save_state()
+
+
+def _prime_preambles(llm: "Llama") -> None:
+    """Prefill the static summary/QA preambles once and keep their KV state."""
+    global _preamble_state_summary, _preamble_state_qa
+    with _llm_lock:
+        llm.reset()
+        _preamble_state_summary = _prefill(llm, SUMMARY_PREAMBLE)
+        _preamble_state_qa = _prefill(llm, QA_PREAMBLE)
+
+
+def _restore_preamble(llm: "Llama", kind: Optional[PromptKind], prompt: str) -> str:
+    """Load the cached KV state for a prompt kind and return its preamble.
+
+    The state is only loaded when the live context does not already cover the
+    preamble, so a longer shared prefix from the previous call is kept.
+    """
+    if kind is None:
+        return ""
+    if kind == "summary":
+        preamble, state = SUMMARY_PREAMBLE, _preamble_state_summary
+    else:
+        preamble, state = QA_PREAMBLE, _preamble_state_qa
+    if state is not None:
+        tokens = llm.tokenize((preamble + prompt).encode("utf-8"), special=True)
+        n_past = Llama.longest_token_prefix(llm.input_ids[: llm.n_tokens].tolist(), tokens)
+        if n_past < state.n_tokens:
+            llm.load_state(state)
+    return preamble
+
+
+def _restore_report(llm: "Llama", prefix: str) -> None:
+    """Load the cached KV state for a preamble + report prefix, prefilling on miss."""
+    key = ReportKVCache.key(prefix)
+    state = _report_cache.get(key)
+    if state is None:
+        _report_cache.put(key, _prefill(llm, prefix))
+    else:
+        llm.load_state(state)
 
 
 def _download_model(url: str, dest_path: str) -> None:
     """Download a GGUF model file to the given destination path."""
     dest = Path(dest_path)
     dest.parent.mkdir(parents=True, exist_ok=True)
+    # Write next to the destination and rename when complete, so an interrupted
+    # download never leaves a truncated file that passes the exists() check.
+    part = dest.with_name(dest.name + ".part")
     try:
         with urlopen(url, timeout=120) as response:
             if response.status != 200:
@@ -88,123 +397,424 @@ def _download_model(url: str, dest_path: str) -> None:
                     status_code=500,
                     detail=f"Failed to download model: HTTP {response.status}",
                 )
-            with open(dest, "wb") as f:
+            expected = int(response.headers.get("Content-Length") or 0)
+            received = 0
+            with open(part, "wb") as f:
+                _preallocate(f.fileno(), expected)
                 while True:
-                    chunk = response.read(1024 * 1024)
+                    chunk = response.read(DOWNLOAD_CHUNK_SIZE)
                     if not chunk:
                         break
                     f.write(chunk)
+                    received += len(chunk)
+        # A dropped connection ends the read loop without an error, and the
+        # preallocated file would still have the full size.
+        if expected and received != expected:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Failed to download model: got {received} of {expected} bytes",
+            )
+        os.replace(part, dest)
     except HTTPException:
+        _remove_file(str(part))
         raise
     except Exception as exc:
+        _remove_file(str(part))
         raise HTTPException(
             status_code=500,
             detail=f"Failed to download model: {exc}",
         )
 
 
-def _extract_text_from_pdf(file_bytes: bytes) -> str:
+def _preallocate(fd: int, length: int) -> None:
+    """Reserve disk space for a download of known size, where supported."""
+    if length <= 0 or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(fd, 0, length)
+    except OSError:
+        pass
+
+
+def _extract_text_from_pdf(path: str) -> str:
     """Extract concatenated text from all non-empty PDF pages."""
-    reader = PdfReader(BytesIO(file_bytes))
+    with open(path, "rb") as f:
+        # pypdf reads objects lazily from the open file instead of a full copy.
+        reader = PdfReader(f)
+        n_pages = len(reader.pages)
+        workers = min(PDF_EXTRACT_WORKERS, n_pages // PDF_PAGES_PER_WORKER)
+        if workers <= 1:
+            pages_text = _extract_pages(reader, 0, n_pages)
+    if workers > 1:
+        # A PdfReader shares one stream between pages, so each worker process
+        # opens its own reader for a contiguous range; map() keeps page order.
+        step = -(-n_pages // workers)
+        starts = range(0, n_pages, step)
+        stops = [min(start + step, n_pages) for start in starts]
+        pool = _get_pdf_pool()
+        try:
+            ranges = pool.map(_extract_page_range, [path] * len(stops), starts, stops)
+            pages_text = [text for texts in ranges for text in texts]
+        except BrokenProcessPool:
+            # A worker died (e.g. out of memory on a hostile PDF); later
+            # requests get a fresh pool instead of failing on this one.
+            _discard_pdf_pool(pool)
+            raise
+    return "\n\n".join(pages_text).strip()
+
+
+def _extract_pages(reader: PdfReader, start: int, stop: int) -> List[str]:
+    """Return the non-empty texts of pages[start:stop]."""
     pages_text: List[str] = []
-    for page in reader.pages:
-        text = page.extract_text() or ""
+    for idx in range(start, stop):
+        text = reader.pages[idx].extract_text() or ""
         if text.strip():
             pages_text.append(text)
-    return "\n\n".join(pages_text).strip()
+    return pages_text
+
+
+def _extract_page_range(path: str, start: int, stop: int) -> List[str]:
+    """Open a PDF and return the non-empty texts of pages[start:stop]."""
+    with open(path, "rb") as f:
+        return _extract_pages(PdfReader(f), start, stop)
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    """Create the PDF extraction process pool on first use."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # spawn: forking a process that holds llama.cpp threads is unsafe.
+            _pdf_pool = ProcessPoolExecutor(
+                max_workers=PDF_EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pdf_pool
+
+
+def _discard_pdf_pool(pool: ProcessPoolExecutor) -> None:
+    """Drop a broken PDF extraction pool so the next use creates a new one."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            _pdf_pool = None
+    pool.shutdown(wait=False)
+
+
+def _shutdown_pdf_pool() -> None:
+    """Stop the PDF extraction workers, if they were started."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is not None:
+            _pdf_pool.shutdown(cancel_futures=True)
+            _pdf_pool = None
+
+
+def _spool_upload(upload: UploadFile) -> Tuple[str, str]:
+    """Copy an uploaded file to a temporary path; return the path and content hash."""
+    digest = blake2b()
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        while True:
+            chunk = upload.file.read(1 << 20)
+            if not chunk:
+                break
+            digest.update(chunk)
+            tmp.write(chunk)
+    return tmp.name, digest.hexdigest()
+
+
+def _extract_cached(path: str, digest: str) -> str:
+    """Extract PDF text, reusing the result for previously seen uploads."""
+    text = _text_cache.get(digest)
+    if text is None:
+        text = _extract_text_from_pdf(path)
+        _text_cache.put(digest, text)
+    return text
+
+
+def _remove_file(path: str) -> None:
+    """Delete a temporary file if it still exists."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+async def _extract_spooled(path: str, digest: str) -> str:
+    """Extract text from a spooled upload off the event loop, then delete it."""
+    try:
+        return await asyncio.to_thread(_extract_cached, path, digest)
+    finally:
+        _remove_file(path)
 
 
-def _chunk_text(text: str, max_chars: int = 8000) -> List[str]:
-    """Split text into fixed-size chunks by character count."""
-    if len(text) <= max_chars:
+async def _read_and_extract(upload: UploadFile) -> str:
+    """Spool an upload to disk and extract its text off the event loop."""
+    path, digest = await asyncio.to_thread(_spool_upload, upload)
+    return await _extract_spooled(path, digest)
+
+
+def _count_tokens(llm: "Llama", text: str) -> int:
+    """Return the number of model tokens in a piece of text."""
+    return len(llm.tokenize(text.encode("utf-8"), add_bos=False))
+
+
+def _chunk_text(llm: "Llama", text: str, max_tokens: int = CHUNK_MAX_TOKENS) -> List[str]:
+    """Split text into chunks of at most max_tokens tokens on paragraph boundaries."""
+    if _count_tokens(llm, text) <= max_tokens:
         return [text]
-    chunks = []
+    return _pack_pieces(llm, text, max_tokens, ("\n\n", "\n"))
+
+
+def _pack_pieces(llm: "Llama", text: str, max_tokens: int, separators: tuple) -> List[str]:
+    """Greedily pack separator-delimited pieces of text into token-bounded chunks.
+
+    Pieces that are too long on their own are split on the next separator,
+    and as a last resort into raw token windows.
+    """
+    if not separators:
+        return _split_token_windows(llm, text, max_tokens)
+    sep = separators[0]
+    chunks: List[str] = []
+    current: List[str] = []
+    current_tokens = 0
+    for piece in text.split(sep):
+        size = _count_tokens(llm, piece) + 1  # +1 for the separator
+        if current and current_tokens + size > max_tokens:
+            chunks.append(sep.join(current))
+            current, current_tokens = [], 0
+        if size > max_tokens:
+            chunks.extend(_pack_pieces(llm, piece, max_tokens, separators[1:]))
+            continue
+        current.append(piece)
+        current_tokens += size
+    if current:
+        chunks.append(sep.join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def _split_token_windows(llm: "Llama", text: str, max_tokens: int) -> List[str]:
+    """Split text into windows of at most max_tokens tokens.
+
+    Byte-level tokens can end inside a multibyte character (common in
+    Cyrillic text), so each window edge is moved back to the last token
+    boundary that decodes cleanly.
+    """
+    tokens = llm.tokenize(text.encode("utf-8"), add_bos=False)
+    windows: List[str] = []
     start = 0
-    while start < len(text):
-        end = min(start + max_chars, len(text))
-        chunks.append(text[start:end])
-        start = end
-    return chunks
+    while start < len(tokens):
+        stop = min(start + max_tokens, len(tokens))
+        while True:
+            data = llm.detokenize(tokens[start:stop])
+            try:
+                windows.append(data.decode("utf-8"))
+                break
+            except UnicodeDecodeError as exc:
+                if exc.reason != "unexpected end of data" or stop - start == 1:
+                    windows.append(data.decode("utf-8", errors="replace"))
+                    break
+                stop -= 1
+        start = stop
+    return windows
 
 
 def _generate(
     llm: "Llama",
     prompt: str,
+    kind: Optional[PromptKind] = None,
+    cached_prefix: Optional[str] = None,
     max_tokens: int = 512,
     repeat_penalty: float = 1.2,
     frequency_penalty: float = 0.0,
 ) -> str:
-    """Generate text from the local LLM with tuned sampling settings."""
-    response = llm(
-        prompt,
-        max_tokens=max_tokens,
-        temperature=0.2,
-        top_p=0.95,
-        repeat_penalty=repeat_penalty,
-        frequency_penalty=frequency_penalty,
-        stop=["</s>", "###"],
+    """Generate text from the local LLM with tuned sampling settings.
+
+    With ``kind`` set, ``prompt`` is only the variable part of a summary/QA
+    prompt: the preamble KV state is restored first, so llama.cpp's prefix
+    match evaluates just the new tokens. ``cached_prefix`` (the leading part of
+    ``prompt``) is additionally kept in the report KV cache for later calls.
+    """
+    pieces = _generate_stream(
+        llm, prompt, kind, cached_prefix, max_tokens, repeat_penalty, frequency_penalty
     )
-    return (response["choices"][0]["text"] or "").strip()
+    return "".join(pieces).strip()
 
 
-def _build_summary_prompt(text: str) -> str:
-    """Build the English summary prompt for a report excerpt."""
-    return (
-        "You are an analyst assistant. Write in English. Produce EXACTLY 5–10 sentences. "
-        "No meta commentary (e.g., 'the report says...'). "
-        "No lists or numbering, only coherent and logically ordered prose. "
-        "Use only facts from the report, no speculation. Do not repeat yourself.\n\n"
-        f"REPORT:\n{text}\n\nSUMMARY (5–10 sentences):\n"
+def _generate_stream(
+    llm: "Llama",
+    prompt: str,
+    kind: Optional[PromptKind] = None,
+    cached_prefix: Optional[str] = None,
+    max_tokens: int = 512,
+    repeat_penalty: float = 1.2,
+    frequency_penalty: float = 0.0,
+) -> Iterator[str]:
+    """Yield generated text pieces as the LLM decodes them (see _generate).
+
+    The model lock is held until the iterator is exhausted, so consume it
+    fully and from a single thread.
+    """
+    with _llm_lock:
+        preamble = _restore_preamble(llm, kind, prompt)
+        if cached_prefix is not None:
+            _restore_report(llm, preamble + cached_prefix)
+        for chunk in llm(
+            preamble + prompt,
+            max_tokens=max_tokens,
+            temperature=0.2,
+            top_p=0.95,
+            repeat_penalty=repeat_penalty,
+            frequency_penalty=frequency_penalty,
+            stop=["</s>", "###"],
+            stream=True,
+        ):
+            piece = chunk["choices"][0]["text"]
+            if piece:
+                yield piece
+
+
+async def _iterate_in_thread(items: Iterator[Any]) -> AsyncIterator[Any]:
+    """Drain a blocking iterator in a worker thread and yield its items.
+
+    The event loop keeps serving other requests while the LLM decodes. If the
+    consumer stops early (e.g. the client disconnected), the iterator is
+    closed after the item in progress, releasing the model lock.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+    abandoned = threading.Event()
+
+    def _pump() -> None:
+        try:
+            for item in items:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+                if abandoned.is_set():
+                    break
+        finally:
+            close = getattr(items, "close", None)
+            if close is not None:
+                close()
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    def _log_failure(future: "asyncio.Future") -> None:
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning("Abandoned generation failed: %s", future.exception())
+
+    worker = loop.run_in_executor(None, _pump)
+    finished = False
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            yield item
+        finished = True
+    finally:
+        if not finished:
+            abandoned.set()
+            # Nobody awaits the worker any more; retrieve its error here.
+            worker.add_done_callback(_log_failure)
+    await worker
+
+
+def _remote_generate(server_url: str, prompt: str, max_tokens: int) -> str:
+    """Generate text with a llama-server /completion request."""
+    payload = {
+        "prompt": prompt,
+        "n_predict": max_tokens,
+        "temperature": 0.2,
+        "top_p": 0.95,
+        "repeat_penalty": 1.2,
+        "stop": ["</s>", "###"],
+        "cache_prompt": True,
+    }
+    request = Request(
+        f"{server_url.rstrip('/')}/completion",
+        data=orjson.dumps(payload),
+        headers={"Content-Type": "application/json"},
     )
+    try:
+        with urlopen(request, timeout=600) as response:
+            data = orjson.loads(response.read())
+    except Exception as exc:
+        raise HTTPException(
+            status_code=500,
+            detail=f"llama-server request failed: {exc}",
+        )
+    return (data.get("content") or "").strip()
+
+
+def _iter_chunk_summaries(llm: "Llama", chunks: List[str], max_tokens: int) -> Iterator[str]:
+    """Yield partial summaries in chunk order.
+
+    If LLAMA_SERVER_URL is set, chunks are sent to llama-server concurrently,
+    up to LLAMA_SERVER_PARALLEL at a time (its slot count), so the slots batch
+    them; otherwise they run one by one in-process.
+    """
+    server_url = os.getenv(SERVER_URL_ENV)
+    if not server_url:
+        for chunk in chunks:
+            yield _generate(llm, _build_summary_prompt(chunk), kind="summary", max_tokens=max_tokens)
+        return
+    prompts = [SUMMARY_PREAMBLE + _build_summary_prompt(chunk) for chunk in chunks]
+    # More in-flight requests than slots would only queue on the server
+    # and run into the socket timeout.
+    workers = max(1, min(len(prompts), _env_int(SERVER_PARALLEL_ENV, 4)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(lambda prompt: _remote_generate(server_url, prompt, max_tokens), prompts)
+
+
+def _summarize_chunks(llm: "Llama", chunks: List[str], max_tokens: int) -> List[str]:
+    """Return the non-empty partial summaries of the given chunks."""
+    return [partial for partial in _iter_chunk_summaries(llm, chunks, max_tokens) if partial]
+
+
+def _build_report_block(text: str) -> str:
+    """Build the REPORT section shared by the summary and QA prompts."""
+    return f"REPORT:\n{text}\n\n"
+
+
+def _build_summary_prompt(text: str) -> str:
+    """Build the variable part of the summary prompt (after SUMMARY_PREAMBLE)."""
+    return _build_report_block(text) + "SUMMARY (5–10 sentences):\n"
 
 
 def _build_qa_prompt(text: str, question: str) -> str:
-    """Build the English QA prompt for a report excerpt and question."""
-    return (
-        "You are an analyst assistant. Write in English. Answer only using the report content. "
-        "No meta commentary or speculation. Do not repeat yourself. "
-        "If the answer is not in the text, say: \"The report does not specify this.\".\n\n"
-        f"REPORT:\n{text}\n\nQUESTION: {question}\nANSWER:\n"
+    """Build the variable part of the QA prompt (after QA_PREAMBLE)."""
+    return _build_report_block(text) + f"QUESTION: {question}\nANSWER:\n"
+
+
+def _generate_answer(
+    llm: "Llama", context: str, question: str, cache_context: bool = False
+) -> str:
+    """Answer a question over a context.
+
+    With ``cache_context`` the context's prefill is kept in the report KV cache
+    for follow-up questions; set it only for the full report text, since
+    retrieved or summarized contexts differ from call to call.
+    """
+    return _generate(
+        llm,
+        _build_qa_prompt(context, question),
+        kind="qa",
+        cached_prefix=_build_report_block(context) if cache_context else None,
+        max_tokens=300,
     )
 
 
 def _split_sentences(text: str) -> List[str]:
     """Split text into sentences using simple punctuation heuristics."""
     # Very simple sentence splitter for RU/EN punctuation.
-    parts = []
-    buf = []
-    for idx, ch in enumerate(text):
-        buf.append(ch)
-        if ch in ".!?":
-            if ch == ".":
-                prev = text[idx - 1] if idx > 0 else ""
-                nxt = text[idx + 1] if idx + 1 < len(text) else ""
-                if prev.isdigit() and nxt.isdigit():
-                    continue
-                if nxt == ".":
-                    continue
-            sentence = "".join(buf).strip()
-            if sentence:
-                parts.append(sentence)
-            buf = []
-    tail = "".join(buf).strip()
-    if tail:
-        parts.append(tail)
-    return parts
+    return [s for s in (m.strip() for m in _SENTENCE_RE.findall(text)) if s]
 
 
 def _sanitize_summary(text: str) -> str:
     """Normalize summary text and remove common numbering artifacts."""
     # Remove common numbering like "1." or "8." at line starts.
-    lines = []
-    for line in text.splitlines():
-        stripped = line.lstrip()
-        if stripped[:2].isdigit() and stripped[1:2] == ".":
-            stripped = stripped[2:].lstrip()
-        elif len(stripped) >= 3 and stripped[0].isdigit() and stripped[1:2].isdigit() and stripped[2:3] == ".":
-            stripped = stripped[3:].lstrip()
-        lines.append(stripped)
-    return " ".join([l for l in lines if l]).strip()
+    lines = (_NUMBERING_RE.sub("", line).strip() for line in text.splitlines())
+    return " ".join(line for line in lines if line)
 
 
 def _is_repetitive(text: str, threshold: int = 6) -> bool:
@@ -212,13 +822,8 @@ def _is_repetitive(text: str, threshold: int = 6) -> bool:
     tokens = text.lower().split()
     if len(tokens) < 20:
         return False
-    counts = {}
-    for i in range(len(tokens) - 2):
-        gram = " ".join(tokens[i : i + 3])
-        counts[gram] = counts.get(gram, 0) + 1
-        if counts[gram] >= threshold:
-            return True
-    return False
+    counts = Counter(zip(tokens, tokens[1:], tokens[2:]))
+    return max(counts.values()) >= threshold
 
 
 def _needs_rewrite(text: str) -> bool:
@@ -268,41 +873,62 @@ def _ensure_summary_quality(llm: "Llama", text: str, summary: str) -> str:
     sentences = _split_sentences(cleaned_retry)
     if len(sentences) > 10:
         return " ".join(sentences[:10]).strip()
-    if len(sentences) < 5:
-        return cleaned_retry
     return cleaned_retry
 
 
 def _summarize_text(llm: "Llama", text: str) -> str:
     """Summarize a report using chunking and map-reduce when needed."""
-    chunks = _chunk_text(text)
+    chunks = _chunk_text(llm, text)
     if len(chunks) == 1:
-        raw = _generate(llm, _build_summary_prompt(chunks[0]), max_tokens=400)
+        raw = _generate(llm, _build_summary_prompt(chunks[0]), kind="summary", max_tokens=400)
         return _ensure_summary_quality(llm, chunks[0], raw)
 
-    partial_summaries = []
-    for chunk in chunks:
-        partial = _generate(llm, _build_summary_prompt(chunk), max_tokens=250)
-        if partial:
-            partial_summaries.append(partial)
+    partial_summaries = _summarize_chunks(llm, chunks, max_tokens=250)
     combined = "\n".join(partial_summaries)
-    raw = _generate(llm, _build_summary_prompt(combined), max_tokens=400)
+    raw = _generate(llm, _build_summary_prompt(combined), kind="summary", max_tokens=400)
     return _ensure_summary_quality(llm, combined, raw)
 
 
+def _embed(embedder: "Llama", texts: List[str]) -> List[List[float]]:
+    """Return unit-length embeddings for a list of texts."""
+    with _embed_lock:
+        return embedder.embed(texts, normalize=True)
+
+
+def _retrieve_context(llm: "Llama", embedder: "Llama", text: str, question: str) -> str:
+    """Select the report passages closest to the question that fit one chunk."""
+    key = blake2b(text.encode("utf-8")).hexdigest()
+    cached = _passage_cache.get(key)
+    if cached is None:
+        passages = _chunk_text(llm, text, RETRIEVAL_PASSAGE_TOKENS)
+        sizes = [_count_tokens(llm, passage) for passage in passages]
+        cached = (passages, _embed(embedder, passages), sizes)
+        _passage_cache.put(key, cached)
+    passages, vectors, sizes = cached
+    query = _embed(embedder, [question])[0]
+    scores = [sum(a * b for a, b in zip(vector, query)) for vector in vectors]
+    selected: List[int] = []
+    used = 0
+    for idx in sorted(range(len(passages)), key=scores.__getitem__, reverse=True):
+        if used + sizes[idx] <= CHUNK_MAX_TOKENS:
+            selected.append(idx)
+            used += sizes[idx]
+    # Keep the selected passages in document order.
+    return "\n\n".join(passages[idx] for idx in sorted(selected))
+
+
 def _answer_question(llm: "Llama", text: str, question: str) -> str:
-    """Answer a question using full text or a summarized context."""
-    chunks = _chunk_text(text)
-    if len(chunks) > 1:
-        partial_summaries = []
-        for chunk in chunks:
-            partial = _generate(llm, _build_summary_prompt(chunk), max_tokens=200)
-            if partial:
-                partial_summaries.append(partial)
-        context = "\n".join(partial_summaries)
-    else:
+    """Answer a question using full text, retrieved passages or a summarized context."""
+    chunks = _chunk_text(llm, text)
+    if len(chunks) == 1:
         context = chunks[0]
-    return _generate(llm, _build_qa_prompt(context, question), max_tokens=300)
+    else:
+        embedder = _load_embedder()
+        if embedder is not None:
+            context = _retrieve_context(llm, embedder, text, question)
+        else:
+            context = "\n".join(_summarize_chunks(llm, chunks, max_tokens=200))
+    return _generate_answer(llm, context, question, cache_context=len(chunks) == 1)
 
 
 @app.post("/summary", response_model=SummaryResponse)
@@ -310,13 +936,12 @@ async def summarize_report(file: UploadFile = File(...)) -> SummaryResponse:
     """Summarize the uploaded PDF and return the summary."""
     if file.content_type != "application/pdf":
         raise HTTPException(status_code=400, detail="Only PDF files are supported.")
-    file_bytes = await file.read()
-    text = _extract_text_from_pdf(file_bytes)
+    text = await _read_and_extract(file)
     if not text:
         raise HTTPException(status_code=400, detail="No extractable text in PDF.")
 
-    llm = _load_llm()
-    summary = _summarize_text(llm, text)
+    llm = await asyncio.to_thread(_load_llm)
+    summary = await asyncio.to_thread(_summarize_text, llm, text)
     return SummaryResponse(summary=summary)
 
 
@@ -331,13 +956,12 @@ async def answer_question(
     if not question.strip():
         raise HTTPException(status_code=400, detail="Question is empty.")
 
-    file_bytes = await file.read()
-    text = _extract_text_from_pdf(file_bytes)
+    text = await _read_and_extract(file)
     if not text:
         raise HTTPException(status_code=400, detail="No extractable text in PDF.")
 
-    llm = _load_llm()
-    answer = _answer_question(llm, text, question)
+    llm = await asyncio.to_thread(_load_llm)
+    answer = await asyncio.to_thread(_answer_question, llm, text, question)
     return QAResponse(answer=answer)
 
 
@@ -346,8 +970,7 @@ async def debug_text(file: UploadFile = File(...)) -> DebugTextResponse:
     """Return a preview and length of extracted PDF text."""
     if file.content_type != "application/pdf":
         raise HTTPException(status_code=400, detail="Only PDF files are supported.")
-    file_bytes = await file.read()
-    text = _extract_text_from_pdf(file_bytes)
+    text = await _read_and_extract(file)
     if not text:
         raise HTTPException(status_code=400, detail="No extractable text in PDF.")
     preview = text[:4000]
@@ -437,6 +1060,7 @@ def home() -> HTMLResponse:
         const reader = res.body.getReader();
         const decoder = new TextDecoder();
         let buffer = '';
+        let draft = '';
         while (true) {
           const { done, value } = await reader.read();
           if (done) break;
@@ -449,6 +1073,10 @@ def home() -> HTMLResponse:
             try {
               const msg = JSON.parse(line);
               if (msg.status) output.textContent = msg.status;
+              if (msg.delta) {
+                draft += msg.delta;
+                output.textContent = draft;
+              }
               if (msg.summary) output.textContent = msg.summary;
               if (msg.answer) output.textContent = msg.answer;
             } catch (_) {
@@ -499,37 +1127,50 @@ async def summarize_report_stream(file: UploadFile = File(...)) -> StreamingResp
     """Stream summary progress and final output for the uploaded PDF."""
     if file.content_type != "application/pdf":
         raise HTTPException(status_code=400, detail="Only PDF files are supported.")
-    file_bytes = await file.read()
+    path, digest = await asyncio.to_thread(_spool_upload, file)
 
     async def _gen():
-        yield '{"status":"Читаю PDF..."}\n'
-        yield '{"status":"Извлекаю текст..."}\n'
-        text = _extract_text_from_pdf(file_bytes)
+        yield _json_line({"status": "Читаю PDF..."})
+        yield _json_line({"status": "Извлекаю текст..."})
+        text = await _extract_spooled(path, digest)
         if not text:
-            yield '{"status":"В PDF нет извлекаемого текста."}\n'
+            yield _json_line({"status": "В PDF нет извлекаемого текста."})
             return
-        yield '{"status":"Загружаю модель..."}\n'
-        llm = _load_llm()
-        chunks = _chunk_text(text)
+        yield _json_line({"status": "Загружаю модель..."})
+        llm = await asyncio.to_thread(_load_llm)
+        chunks = await asyncio.to_thread(_chunk_text, llm, text)
         if len(chunks) == 1:
-            yield '{"status":"Делаю саммари..."}\n'
-            summary = _summarize_text(llm, text)
-            yield f'{{"summary":{_json_escape(summary)}}}\n'
-            return
-        partial_summaries = []
-        total = len(chunks)
-        for idx, chunk in enumerate(chunks, start=1):
-            yield f'{{"status":"Суммирую блок {idx}/{total}..."}}\n'
-            partial = _generate(llm, _build_summary_prompt(chunk), max_tokens=250)
-            if partial:
-                partial_summaries.append(partial)
-        combined = "\n".join(partial_summaries)
-        yield '{"status":"Делаю итоговое саммари..."}\n'
-        raw = _generate(llm, _build_summary_prompt(combined), max_tokens=400)
-        summary = _ensure_summary_quality(llm, combined, raw)
-        yield f'{{"summary":{_json_escape(summary)}}}\n'
-
-    return StreamingResponse(_gen(), media_type="text/plain")
+            context = chunks[0]
+            yield _json_line({"status": "Делаю саммари..."})
+        else:
+            partial_summaries = []
+            total = len(chunks)
+            yield _json_line({"status": f"Суммирую блоки ({total})..."})
+            partials = _iter_chunk_summaries(llm, chunks, max_tokens=250)
+            idx = 0
+            async for partial in _iterate_in_thread(partials):
+                idx += 1
+                yield _json_line({"status": f"Готов блок {idx}/{total}..."})
+                if partial:
+                    partial_summaries.append(partial)
+            context = "\n".join(partial_summaries)
+            yield _json_line({"status": "Делаю итоговое саммари..."})
+        # Forward the draft token by token, then send the checked final version.
+        pieces = _generate_stream(llm, _build_summary_prompt(context), kind="summary", max_tokens=400)
+        raw = []
+        async for piece in _iterate_in_thread(pieces):
+            raw.append(piece)
+            yield _json_line({"delta": piece})
+        summary = await asyncio.to_thread(
+            _ensure_summary_quality, llm, context, "".join(raw).strip()
+        )
+        yield _json_line({"summary": summary})
+
+    return StreamingResponse(
+        _gen(),
+        media_type="text/plain",
+        background=BackgroundTask(_remove_file, path),
+    )
 
 
 @app.post("/qa_stream")
@@ -542,43 +1183,49 @@ async def answer_question_stream(
         raise HTTPException(status_code=400, detail="Only PDF files are supported.")
     if not question.strip():
         raise HTTPException(status_code=400, detail="Question is empty.")
-    file_bytes = await file.read()
+    path, digest = await asyncio.to_thread(_spool_upload, file)
 
     async def _gen():
-        yield '{"status":"Читаю PDF..."}\n'
-        yield '{"status":"Извлекаю текст..."}\n'
-        text = _extract_text_from_pdf(file_bytes)
+        yield _json_line({"status": "Читаю PDF..."})
+        yield _json_line({"status": "Извлекаю текст..."})
+        text = await _extract_spooled(path, digest)
         if not text:
-            yield '{"status":"В PDF нет извлекаемого текста."}\n'
+            yield _json_line({"status": "В PDF нет извлекаемого текста."})
             return
-        yield '{"status":"Загружаю модель..."}\n'
-        llm = _load_llm()
-        chunks = _chunk_text(text)
-        if len(chunks) > 1:
+        yield _json_line({"status": "Загружаю модель..."})
+        llm = await asyncio.to_thread(_load_llm)
+        chunks = await asyncio.to_thread(_chunk_text, llm, text)
+        embedder = await asyncio.to_thread(_load_embedder) if len(chunks) > 1 else None
+        if len(chunks) == 1:
+            context = chunks[0]
+        elif embedder is not None:
+            yield _json_line({"status": "Ищу релевантные фрагменты..."})
+            context = await asyncio.to_thread(_retrieve_context, llm, embedder, text, question)
+        else:
             partial_summaries = []
             total = len(chunks)
-            for idx, chunk in enumerate(chunks, start=1):
-                yield f'{{"status":"Готовлю контекст {idx}/{total}..."}}\n'
-                partial = _generate(llm, _build_summary_prompt(chunk), max_tokens=200)
+            yield _json_line({"status": f"Готовлю контекст ({total} блоков)..."})
+            partials = _iter_chunk_summaries(llm, chunks, max_tokens=200)
+            idx = 0
+            async for partial in _iterate_in_thread(partials):
+                idx += 1
+                yield _json_line({"status": f"Готов блок {idx}/{total}..."})
                 if partial:
                     partial_summaries.append(partial)
             context = "\n".join(partial_summaries)
-        else:
-            context = chunks[0]
-        yield '{"status":"Ищу ответ..."}\n'
-        answer = _generate(llm, _build_qa_prompt(context, question), max_tokens=300)
-        yield f'{{"answer":{_json_escape(answer)}}}\n'
+        yield _json_line({"status": "Ищу ответ..."})
+        answer = await asyncio.to_thread(
+            _generate_answer, llm, context, question, len(chunks) == 1
+        )
+        yield _json_line({"answer": answer})
 
-    return StreamingResponse(_gen(), media_type="text/plain")
+    return StreamingResponse(
+        _gen(),
+        media_type="text/plain",
+        background=BackgroundTask(_remove_file, path),
+    )
 
 
-def _json_escape(value: str) -> str:
-    """Escape a string for newline-delimited JSON streaming output."""
-    escaped = (
-        value.replace("\\\\", "\\\\\\\\")
-        .replace("\\n", "\\\\n")
-        .replace("\\r", "\\\\r")
-        .replace("\\t", "\\\\t")
-        .replace('"', '\\"')
-    )
-    return f'"{escaped}"'
+def _json_line(payload: dict) -> bytes:
+    """Serialize one newline-delimited JSON message for streaming output."""
+    return orjson.dumps(payload) + b"\n"